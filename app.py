@@ -1,13 +1,29 @@
 from flask import Flask, render_template, request, redirect, url_for, session, flash
-import sqlite3
+try:
+    # ships a much newer SQLite than most distro CPython builds
+    # (better planner, self-limiting PRAGMA optimize, upsert improvements)
+    import pysqlite3 as sqlite3
+except ImportError:
+    import sqlite3
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+import functools
 import hashlib
+import hmac
 import os
+import time
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerifyMismatchError
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "change-this-secret")
 
 DB_PATH = os.getenv("CARWASH_DB_PATH", "carwash.db")
+POOL_SIZE = int(os.getenv("CARWASH_POOL_SIZE", "5"))
 
 # -----------------
 # Helpers
@@ -15,16 +31,104 @@ DB_PATH = os.getenv("CARWASH_DB_PATH", "carwash.db")
 def now_str():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+_ph = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=1)
+
+# verified against when the phone doesn't exist, so unknown and known
+# accounts cost the same on the login path
+_DUMMY_HASH = _ph.hash("not-a-real-password")
+
 def hash_password(pw: str) -> str:
+    # argon2id; the returned string embeds salt and cost parameters
+    return _ph.hash(pw)
+
+def _legacy_hash(pw: str) -> str:
+    # pre-argon2 rows stored bare sha256 hex; kept only for migration on login
     return hashlib.sha256(pw.encode("utf-8")).hexdigest()
 
-def get_conn():
+# -----------------
+# Connection pool
+# -----------------
+_pool = queue.Queue(maxsize=POOL_SIZE)
+_pool_lock = threading.Lock()
+_pool_ready = False
+_release_count = 0
+OPTIMIZE_EVERY = 500  # run PRAGMA optimize every N connection releases
+
+def _optimize(conn):
+    # SQLite < 3.46 needs an explicit bound on the ANALYZE work;
+    # newer versions limit themselves.
+    if sqlite3.sqlite_version_info < (3, 46, 0):
+        conn.execute("PRAGMA analysis_limit = 1000;")
+    conn.execute("PRAGMA optimize;")
+
+def _new_conn():
+    # default isolation level: sqlite3 opens an implicit transaction
+    # before the first write and conn.commit() ends it, so multi-write
+    # routes stay atomic
     conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # Row supports both positional and named access, so existing
+    # templates keep working while new code can use column names
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
     conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA cache_size = -32000;")
+    conn.execute("PRAGMA mmap_size = 268435456;")
+    conn.execute("PRAGMA busy_timeout = 5000;")
     return conn
 
+def _init_pool():
+    global _pool_ready
+    with _pool_lock:
+        if _pool_ready:
+            return
+        for _ in range(POOL_SIZE):
+            _pool.put(_new_conn())
+        _pool_ready = True
+
+# -----------------
+# Reference-data cache (stages / packages change rarely)
+# -----------------
+_ref_lock = threading.Lock()
+_ref_cache = {}
+
+def _refresh_ref_cache(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT stage_id, stage_name, stage_order FROM service_stages ORDER BY stage_order")
+    stage_rows = cur.fetchall()
+    cur.execute("SELECT package_id, package_name, price, duration_minutes, is_active FROM packages ORDER BY package_id DESC")
+    package_rows = cur.fetchall()
+    with _ref_lock:
+        _ref_cache["stages"] = [(r[0], r[1]) for r in stage_rows]
+        _ref_cache["stage_order"] = {r[0]: r[2] for r in stage_rows}
+        _ref_cache["first_stage_id"] = stage_rows[0][0] if stage_rows else None
+        _ref_cache["max_order"] = stage_rows[-1][2] if stage_rows else None
+        _ref_cache["packages"] = package_rows
+        _ref_cache["active_packages"] = sorted(
+            ((r[0], r[1], r[2], r[3]) for r in package_rows if r[4] == 1),
+            key=lambda r: r[2])
+
+def _ref(key):
+    with _ref_lock:
+        return _ref_cache[key]
+
+@contextmanager
+def conn_ctx():
+    global _release_count
+    conn = _pool.get()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        _release_count += 1
+        if _release_count % OPTIMIZE_EVERY == 0:
+            _optimize(conn)
+        _pool.put(conn)
+
 def init_db():
-    conn = get_conn()
+    conn = _new_conn()
     cur = conn.cursor()
 
     # users
@@ -99,15 +203,15 @@ def init_db():
     );
     """)
 
-    # stage history
-    cur.execute("""
+    # stage history (updated_by_staff_id NULL = system-created entry)
+    history_ddl = """
     CREATE TABLE IF NOT EXISTS booking_stage_history (
         history_id INTEGER PRIMARY KEY AUTOINCREMENT,
         booking_id INTEGER NOT NULL,
         stage_id INTEGER NOT NULL,
         start_time TEXT NOT NULL,
         end_time TEXT,
-        updated_by_staff_id INTEGER NOT NULL,
+        updated_by_staff_id INTEGER,
 
         FOREIGN KEY(booking_id) REFERENCES bookings(booking_id)
             ON UPDATE CASCADE ON DELETE CASCADE,
@@ -116,7 +220,17 @@ def init_db():
         FOREIGN KEY(updated_by_staff_id) REFERENCES users(user_id)
             ON UPDATE CASCADE ON DELETE RESTRICT
     );
-    """)
+    """
+    cur.execute(history_ddl)
+
+    # migrate pre-existing DBs where the column was still NOT NULL
+    cur.execute("PRAGMA table_info(booking_stage_history);")
+    col_info = {row[1]: row for row in cur.fetchall()}
+    if col_info["updated_by_staff_id"][3]:  # notnull flag
+        cur.execute("ALTER TABLE booking_stage_history RENAME TO booking_stage_history_old;")
+        cur.execute(history_ddl)
+        cur.execute("INSERT INTO booking_stage_history SELECT * FROM booking_stage_history_old;")
+        cur.execute("DROP TABLE booking_stage_history_old;")
 
     # staff assignment M:N
     cur.execute("""
@@ -146,6 +260,16 @@ def init_db():
     );
     """)
 
+    # Indexes for the hot lookup/join columns. users.phone needs none:
+    # its UNIQUE constraint already maintains one, so drop the redundant
+    # copy on databases that got it.
+    cur.execute("DROP INDEX IF EXISTS idx_users_phone;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_vehicles_customer ON vehicles(customer_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookings_customer ON bookings(customer_id, booking_id DESC);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookings_status ON bookings(status, booking_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_history_booking ON booking_stage_history(booking_id, history_id DESC);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_assign_booking ON booking_staff_assignment(booking_id, assigned_at DESC);")
+
     # Seed stages
     cur.execute("SELECT COUNT(*) FROM service_stages;")
     if cur.fetchone()[0] == 0:
@@ -173,8 +297,49 @@ def init_db():
         """, ("Admin", "0300-0000000", "admin@carwash.local", hash_password("admin123"), "Admin", now_str()))
 
     conn.commit()
+    _optimize(conn)
+    _refresh_ref_cache(conn)
     conn.close()
 
+# -----------------
+# Short-TTL response cache for the dashboards
+# -----------------
+_resp_lock = threading.Lock()
+_resp_cache = {}  # view name -> {(user_id, role): (expires_at, response)}
+
+def ttl_cache(seconds=2):
+    def deco(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            uid = session.get("user_id")
+            # pending flashes must be rendered fresh, exactly once:
+            # serving a cached page would leave them queued, and caching
+            # a page that shows one would replay it on every hit
+            if uid is None or "_flashes" in session:
+                return view(*args, **kwargs)
+            key = (uid, session.get("role"), request.query_string)
+            now = time.monotonic()
+            with _resp_lock:
+                hit = _resp_cache.get(view.__name__, {}).get(key)
+                if hit and hit[0] > now:
+                    return hit[1]
+            resp = view(*args, **kwargs)
+            if "_flashes" in session:
+                return resp
+            with _resp_lock:
+                entries = _resp_cache.setdefault(view.__name__, {})
+                for k in [k for k, (expires, _) in entries.items() if expires <= now]:
+                    del entries[k]
+                entries[key] = (now + seconds, resp)
+            return resp
+        return wrapper
+    return deco
+
+def _cache_invalidate(*view_names):
+    with _resp_lock:
+        for name in view_names:
+            _resp_cache.pop(name, None)
+
 # -----------------
 # Guards
 # -----------------
@@ -184,11 +349,11 @@ def require_login():
 def require_staff():
     return require_login() and session.get("role") in ("Staff", "Admin")
 
-@app.before_request
-def _startup():
-    if not getattr(app, "_db_inited", False):
-        init_db()
-        app._db_inited = True
+# Schema and pool are set up once at import time. Under a preloading
+# server this runs in the master, otherwise once per worker; both are
+# fine since the DDL is all IF NOT EXISTS.
+init_db()
+_init_pool()
 
 # -----------------
 # Routes
@@ -207,14 +372,39 @@ def login():
         phone = request.form.get("phone","").strip()
         password = request.form.get("password","").strip()
 
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, full_name, role FROM users WHERE phone=? AND password_hash=?",
-                    (phone, hash_password(password)))
-        row = cur.fetchone()
-        conn.close()
-
-        if not row:
+        with conn_ctx() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT user_id, full_name, role, password_hash FROM users WHERE phone=?",
+                        (phone,))
+            row = cur.fetchone()
+
+            ok = False
+            if row:
+                stored = row[3]
+                try:
+                    _ph.verify(stored, password)
+                    ok = True
+                    if _ph.check_needs_rehash(stored):
+                        cur.execute("UPDATE users SET password_hash=? WHERE user_id=?",
+                                    (hash_password(password), row[0]))
+                        conn.commit()
+                except VerifyMismatchError:
+                    ok = False
+                except InvalidHashError:
+                    # legacy sha256 row: constant-time check, then upgrade in place
+                    if hmac.compare_digest(_legacy_hash(password), stored):
+                        ok = True
+                        cur.execute("UPDATE users SET password_hash=? WHERE user_id=?",
+                                    (hash_password(password), row[0]))
+                        conn.commit()
+            else:
+                # burn the same verify work for unknown phones
+                try:
+                    _ph.verify(_DUMMY_HASH, password)
+                except VerifyMismatchError:
+                    pass
+
+        if not ok:
             flash("Invalid phone or password", "danger")
             return redirect(url_for("login"))
 
@@ -240,14 +430,13 @@ def register():
             return redirect(url_for("register"))
 
         try:
-            conn = get_conn()
-            cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO users(full_name, phone, email, password_hash, role, created_at)
-                VALUES(?,?,?,?, 'Customer', ?)
-            """, (full_name, phone, email, hash_password(password), now_str()))
-            conn.commit()
-            conn.close()
+            with conn_ctx() as conn:
+                cur = conn.cursor()
+                cur.execute("""
+                    INSERT INTO users(full_name, phone, email, password_hash, role, created_at)
+                    VALUES(?,?,?,?, 'Customer', ?)
+                """, (full_name, phone, email, hash_password(password), now_str()))
+                conn.commit()
             flash("Registered successfully. Please login.", "success")
             return redirect(url_for("login"))
         except sqlite3.IntegrityError as e:
@@ -266,122 +455,115 @@ def booking_detail(booking_id):
     if not require_login():
         return redirect(url_for("login"))
 
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute("""
-    SELECT b.booking_id, b.booking_datetime, b.scheduled_datetime, b.status, b.notes,
-           u.full_name, v.plate_no, p.package_name, p.price,
-           s.stage_name
-    FROM bookings b
-    JOIN users u ON u.user_id=b.customer_id
-    JOIN vehicles v ON v.vehicle_id=b.vehicle_id
-    JOIN packages p ON p.package_id=b.package_id
-    LEFT JOIN service_stages s ON s.stage_id=b.current_stage_id
-    WHERE b.booking_id=?
-    """, (booking_id,))
-    booking = cur.fetchone()
-
-    if not booking:
-        conn.close()
-        flash("Booking not found.", "danger")
-        return redirect(url_for("home"))
+    with conn_ctx() as conn:
+        cur = conn.cursor()
 
-    # customer can only view own booking
-    if session["role"] == "Customer":
-        cur.execute("SELECT customer_id FROM bookings WHERE booking_id=?", (booking_id,))
-        owner_id = cur.fetchone()[0]
-        if owner_id != session["user_id"]:
-            conn.close()
+        # b.customer_id rides along at the end for the ownership check;
+        # the template only reads the first ten columns
+        cur.execute("""
+        SELECT b.booking_id, b.booking_datetime, b.scheduled_datetime, b.status, b.notes,
+               u.full_name, v.plate_no, p.package_name, p.price,
+               s.stage_name, b.customer_id
+        FROM bookings b
+        JOIN users u ON u.user_id=b.customer_id
+        JOIN vehicles v ON v.vehicle_id=b.vehicle_id
+        JOIN packages p ON p.package_id=b.package_id
+        LEFT JOIN service_stages s ON s.stage_id=b.current_stage_id
+        WHERE b.booking_id=?
+        """, (booking_id,))
+        booking = cur.fetchone()
+
+        if not booking:
+            flash("Booking not found.", "danger")
+            return redirect(url_for("home"))
+
+        # customer can only view own booking
+        if session["role"] == "Customer" and booking[10] != session["user_id"]:
             flash("Not allowed.", "danger")
             return redirect(url_for("customer_dashboard"))
 
-    cur.execute("""
-    SELECT ss.stage_name, h.start_time, h.end_time, uu.full_name
-    FROM booking_stage_history h
-    JOIN service_stages ss ON ss.stage_id=h.stage_id
-    JOIN users uu ON uu.user_id=h.updated_by_staff_id
-    WHERE h.booking_id=?
-    ORDER BY h.history_id DESC
-    """, (booking_id,))
-    history = cur.fetchall()
+        cur.execute("""
+        SELECT ss.stage_name, h.start_time, h.end_time, COALESCE(uu.full_name, 'System')
+        FROM booking_stage_history h
+        JOIN service_stages ss ON ss.stage_id=h.stage_id
+        LEFT JOIN users uu ON uu.user_id=h.updated_by_staff_id
+        WHERE h.booking_id=?
+        ORDER BY h.history_id DESC
+        """, (booking_id,))
+        history = cur.fetchall()
 
-    cur.execute("""
-    SELECT amount, method, payment_status, paid_at
-    FROM payments WHERE booking_id=?
-    """, (booking_id,))
-    payment = cur.fetchone()
+        cur.execute("""
+        SELECT amount, method, payment_status, paid_at
+        FROM payments WHERE booking_id=?
+        """, (booking_id,))
+        payment = cur.fetchone()
 
-    # assigned staff
-    cur.execute("""
-    SELECT u.full_name, u.role, a.assigned_at
-    FROM booking_staff_assignment a
-    JOIN users u ON u.user_id=a.staff_id
-    WHERE a.booking_id=?
-    ORDER BY a.assigned_at DESC
-    """, (booking_id,))
-    assigned = cur.fetchall()
+        # assigned staff
+        cur.execute("""
+        SELECT u.full_name, u.role, a.assigned_at
+        FROM booking_staff_assignment a
+        JOIN users u ON u.user_id=a.staff_id
+        WHERE a.booking_id=?
+        ORDER BY a.assigned_at DESC
+        """, (booking_id,))
+        assigned = cur.fetchall()
 
-    conn.close()
     return render_template("booking_detail.html", booking=booking, history=history, payment=payment, assigned=assigned)
 
 
 # -------- Customer dashboard --------
 @app.route("/customer")
+@ttl_cache(seconds=2)
 def customer_dashboard():
     if not require_login() or session["role"] != "Customer":
         return redirect(url_for("login"))
 
     uid = session["user_id"]
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute("""
-      SELECT vehicle_id, plate_no, make, model, color, vehicle_type
-      FROM vehicles WHERE customer_id=? ORDER BY vehicle_id DESC
-    """, (uid,))
-    vehicles = cur.fetchall()
-
-    cur.execute("""
-      SELECT package_id, package_name, price, duration_minutes
-      FROM packages WHERE is_active=1 ORDER BY price
-    """)
-    packages = cur.fetchall()
+    with conn_ctx() as conn:
+        cur = conn.cursor()
 
-    cur.execute("""
-    SELECT b.booking_id, b.booking_datetime, b.status,
-           v.plate_no, p.package_name, p.price,
-           s.stage_name
-    FROM bookings b
-    JOIN vehicles v ON v.vehicle_id=b.vehicle_id
-    JOIN packages p ON p.package_id=b.package_id
-    LEFT JOIN service_stages s ON s.stage_id=b.current_stage_id
-    WHERE b.customer_id=?
-    ORDER BY b.booking_id DESC
-    """, (uid,))
-    bookings = cur.fetchall()
-
-    # history map (latest 4 entries per booking)
-    booking_ids = [b[0] for b in bookings]
-    cust_history_map = {}
-
-    if booking_ids:
-        placeholders = ",".join(["?"] * len(booking_ids))
-        cur.execute(f"""
-        SELECT h.booking_id, ss.stage_name, h.start_time, h.end_time
-        FROM booking_stage_history h
-        JOIN service_stages ss ON ss.stage_id=h.stage_id
-        WHERE h.booking_id IN ({placeholders})
-        ORDER BY h.history_id DESC
-        """, booking_ids)
+        cur.execute("""
+          SELECT vehicle_id, plate_no, make, model, color, vehicle_type
+          FROM vehicles WHERE customer_id=? ORDER BY vehicle_id DESC
+        """, (uid,))
+        vehicles = cur.fetchall()
 
-        rows = cur.fetchall()
-        for booking_id, stage_name, start_time, end_time in rows:
-            cust_history_map.setdefault(booking_id, [])
-            if len(cust_history_map[booking_id]) < 4:
-                cust_history_map[booking_id].append((stage_name, start_time, end_time))
+        packages = _ref("active_packages")
 
-    conn.close()
+        cur.execute("""
+        SELECT b.booking_id, b.booking_datetime, b.status,
+               v.plate_no, p.package_name, p.price,
+               s.stage_name
+        FROM bookings b
+        JOIN vehicles v ON v.vehicle_id=b.vehicle_id
+        JOIN packages p ON p.package_id=b.package_id
+        LEFT JOIN service_stages s ON s.stage_id=b.current_stage_id
+        WHERE b.customer_id=?
+        ORDER BY b.booking_id DESC
+        """, (uid,))
+        bookings = cur.fetchall()
+
+        # history map (latest 4 entries per booking, ranked in SQL)
+        booking_ids = [b[0] for b in bookings]
+        cust_history_map = {}
+
+        if booking_ids:
+            placeholders = ",".join(["?"] * len(booking_ids))
+            cur.execute(f"""
+            WITH ranked AS (
+              SELECT h.booking_id, ss.stage_name, h.start_time, h.end_time,
+                     ROW_NUMBER() OVER (PARTITION BY h.booking_id ORDER BY h.history_id DESC) AS rn
+              FROM booking_stage_history h
+              JOIN service_stages ss ON ss.stage_id=h.stage_id
+              WHERE h.booking_id IN ({placeholders})
+            )
+            SELECT booking_id, stage_name, start_time, end_time
+            FROM ranked WHERE rn <= 4
+            ORDER BY booking_id, rn
+            """, booking_ids)
+
+            for booking_id, stage_name, start_time, end_time in cur.fetchall():
+                cust_history_map.setdefault(booking_id, []).append((stage_name, start_time, end_time))
 
     now_min = datetime.now().strftime("%Y-%m-%dT%H:%M")
     return render_template(
@@ -407,14 +589,14 @@ def add_vehicle():
     vehicle_type = request.form.get("vehicle_type","").strip() or None
 
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("""
-        INSERT INTO vehicles(customer_id, plate_no, make, model, color, vehicle_type)
-        VALUES(?,?,?,?,?,?)
-        """, (session["user_id"], plate_no, make, model, color, vehicle_type))
-        conn.commit()
-        conn.close()
+        with conn_ctx() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+            INSERT INTO vehicles(customer_id, plate_no, make, model, color, vehicle_type)
+            VALUES(?,?,?,?,?,?)
+            """, (session["user_id"], plate_no, make, model, color, vehicle_type))
+            conn.commit()
+        _cache_invalidate("customer_dashboard")
         flash("Vehicle added.", "success")
     except sqlite3.IntegrityError as e:
         flash(f"Could not add vehicle: {e}", "danger")
@@ -434,111 +616,133 @@ def create_booking():
 
     notes = request.form.get("notes", "").strip() or None
 
-    conn = get_conn()
-    cur = conn.cursor()
+    ts = now_str()
+    with conn_ctx() as conn:
+        cur = conn.cursor()
 
-    # first stage
-    cur.execute("SELECT stage_id FROM service_stages ORDER BY stage_order LIMIT 1")
-    first_stage_id = cur.fetchone()[0]
+        first_stage_id = _ref("first_stage_id")
 
-    # create booking
-    cur.execute("""
-    INSERT INTO bookings(customer_id, vehicle_id, package_id, booking_datetime, scheduled_datetime, status, current_stage_id, notes)
-    VALUES(?,?,?,?,?,?,?,?)
-    """, (session["user_id"], vehicle_id, package_id, now_str(), scheduled, "Booked", first_stage_id, notes))
+        # booking + history + payment commit (and fsync) as one transaction
+        cur.execute("BEGIN IMMEDIATE")
 
-    booking_id = cur.lastrowid
+        # create booking
+        cur.execute("""
+        INSERT INTO bookings(customer_id, vehicle_id, package_id, booking_datetime, scheduled_datetime, status, current_stage_id, notes)
+        VALUES(?,?,?,?,?,?,?,?)
+        """, (session["user_id"], vehicle_id, package_id, ts, scheduled, "Booked", first_stage_id, notes))
 
-    # create initial history entry (system-created by Admin user_id=1)
-    cur.execute("""
-    INSERT INTO booking_stage_history(booking_id, stage_id, start_time, end_time, updated_by_staff_id)
-    VALUES(?,?,?,?,?)
-    """, (booking_id, first_stage_id, now_str(), None, 1))
+        booking_id = cur.lastrowid
 
-    # payment row (unpaid)
-    cur.execute("SELECT price FROM packages WHERE package_id=?", (package_id,))
-    pkg_price = cur.fetchone()[0]
+        # create initial history entry (NULL staff id = system-created)
+        cur.execute("""
+        INSERT INTO booking_stage_history(booking_id, stage_id, start_time, end_time, updated_by_staff_id)
+        VALUES(?,?,?,?,?)
+        """, (booking_id, first_stage_id, ts, None, None))
 
-    cur.execute("""
-    INSERT INTO payments(booking_id, amount, method, payment_status, paid_at)
-    VALUES(?,?,?,?,?)
-    """, (booking_id, float(pkg_price), "Cash", "Unpaid", None))
+        # payment row (unpaid)
+        cur.execute("SELECT price FROM packages WHERE package_id=?", (package_id,))
+        pkg_price = cur.fetchone()[0]
 
-    conn.commit()
-    conn.close()
+        cur.execute("""
+        INSERT INTO payments(booking_id, amount, method, payment_status, paid_at)
+        VALUES(?,?,?,?,?)
+        """, (booking_id, float(pkg_price), "Cash", "Unpaid", None))
+
+        conn.commit()
 
+    _cache_invalidate("customer_dashboard", "staff_dashboard")
     flash(f"Booking created (ID {booking_id}).", "success")
     return redirect(url_for("customer_dashboard"))
 
 # -------- Staff/Admin dashboard --------
+# WAL allows concurrent readers, so the dashboard's independent SELECTs
+# run on worker threads with their own pooled connections
+_executor = ThreadPoolExecutor(max_workers=4)
+
+BOOKINGS_PAGE_SIZE = 200
+
+def _q_all_bookings(page):
+    # one extra row tells us whether a next page exists
+    with conn_ctx() as conn:
+        rows = conn.execute("""
+        SELECT b.booking_id, b.status, c.full_name, v.plate_no, p.package_name
+        FROM bookings b
+        JOIN users c ON c.user_id=b.customer_id
+        JOIN vehicles v ON v.vehicle_id=b.vehicle_id
+        JOIN packages p ON p.package_id=b.package_id
+        ORDER BY b.booking_id DESC
+        LIMIT ? OFFSET ?
+        """, (BOOKINGS_PAGE_SIZE + 1, (page - 1) * BOOKINGS_PAGE_SIZE)).fetchall()
+    return rows[:BOOKINGS_PAGE_SIZE], len(rows) > BOOKINGS_PAGE_SIZE
+
+def _q_staff_users():
+    with conn_ctx() as conn:
+        return conn.execute(
+            "SELECT user_id, full_name, role FROM users WHERE role IN ('Staff','Admin') ORDER BY full_name"
+        ).fetchall()
+
 @app.route("/staff")
+@ttl_cache(seconds=2)
 def staff_dashboard():
     if not require_staff():
         return redirect(url_for("login"))
 
-    conn = get_conn()
-    cur = conn.cursor()
-
-    # Active bookings
-    cur.execute("""
-    SELECT b.booking_id, b.booking_datetime, b.status,
-           c.full_name, v.plate_no, p.package_name,
-           ss.stage_name
-    FROM bookings b
-    JOIN users c ON c.user_id=b.customer_id
-    JOIN vehicles v ON v.vehicle_id=b.vehicle_id
-    JOIN packages p ON p.package_id=b.package_id
-    LEFT JOIN service_stages ss ON ss.stage_id=b.current_stage_id
-    WHERE b.status IN ('Booked','InProgress')
-    ORDER BY b.booking_id ASC
-    """)
-    active = cur.fetchall()
-
-    # History for active bookings (latest 6 rows per booking)
-    active_ids = [r[0] for r in active]
-    history_map = {}
-
-    if active_ids:
-        placeholders = ",".join(["?"] * len(active_ids))
-        cur.execute(f"""
-        SELECT h.booking_id, ss.stage_name, h.start_time, h.end_time, u.full_name
-        FROM booking_stage_history h
-        JOIN service_stages ss ON ss.stage_id=h.stage_id
-        JOIN users u ON u.user_id=h.updated_by_staff_id
-        WHERE h.booking_id IN ({placeholders})
-        ORDER BY h.history_id DESC
-        """, active_ids)
-
-        rows = cur.fetchall()
-        for booking_id, stage_name, start_time, end_time, updated_by in rows:
-            history_map.setdefault(booking_id, [])
-            if len(history_map[booking_id]) < 6:
-                history_map[booking_id].append((stage_name, start_time, end_time, updated_by))
-
-    # All bookings
-    cur.execute("""
-    SELECT b.booking_id, b.status, c.full_name, v.plate_no, p.package_name
-    FROM bookings b
-    JOIN users c ON c.user_id=b.customer_id
-    JOIN vehicles v ON v.vehicle_id=b.vehicle_id
-    JOIN packages p ON p.package_id=b.package_id
-    ORDER BY b.booking_id DESC
-    """)
-    all_bookings = cur.fetchall()
-
-    # Stages
-    cur.execute("SELECT stage_id, stage_name FROM service_stages ORDER BY stage_order")
-    stages = cur.fetchall()
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+    except ValueError:
+        page = 1
 
-    # Staff/Admin users list
-    cur.execute("SELECT user_id, full_name, role FROM users WHERE role IN ('Staff','Admin') ORDER BY full_name")
-    staff_users = cur.fetchall()
+    all_bookings_f = _executor.submit(_q_all_bookings, page)
+    staff_users_f = _executor.submit(_q_staff_users)
 
-    # Packages list
-    cur.execute("SELECT package_id, package_name, price, duration_minutes, is_active FROM packages ORDER BY package_id DESC")
-    packages = cur.fetchall()
+    with conn_ctx() as conn:
+        cur = conn.cursor()
 
-    conn.close()
+        # Active bookings with their latest 6 history rows, in one query
+        cur.execute("""
+        WITH active AS (
+          SELECT b.booking_id, b.booking_datetime, b.status,
+                 c.full_name, v.plate_no, p.package_name,
+                 ss.stage_name
+          FROM bookings b
+          JOIN users c ON c.user_id=b.customer_id
+          JOIN vehicles v ON v.vehicle_id=b.vehicle_id
+          JOIN packages p ON p.package_id=b.package_id
+          LEFT JOIN service_stages ss ON ss.stage_id=b.current_stage_id
+          WHERE b.status IN ('Booked','InProgress')
+        ),
+        hist AS (
+          SELECT h.booking_id, ss.stage_name AS h_stage, h.start_time AS h_start,
+                 h.end_time AS h_end, COALESCE(u.full_name, 'System') AS h_staff,
+                 ROW_NUMBER() OVER (PARTITION BY h.booking_id ORDER BY h.history_id DESC) AS rn
+          FROM booking_stage_history h
+          JOIN service_stages ss ON ss.stage_id=h.stage_id
+          LEFT JOIN users u ON u.user_id=h.updated_by_staff_id
+          WHERE h.booking_id IN (SELECT booking_id FROM active)
+        )
+        SELECT a.*, hist.h_stage, hist.h_start, hist.h_end, hist.h_staff
+        FROM active a
+        LEFT JOIN hist ON hist.booking_id=a.booking_id AND hist.rn <= 6
+        ORDER BY a.booking_id ASC, hist.rn ASC
+        """)
+
+        active = []
+        history_map = {}
+        seen = set()
+        for row in cur.fetchall():
+            booking_id = row[0]
+            if booking_id not in seen:
+                seen.add(booking_id)
+                active.append(tuple(row[:7]))
+            if row[7] is not None:
+                history_map.setdefault(booking_id, []).append((row[7], row[8], row[9], row[10]))
+
+        # Stages / packages come from the reference cache
+        stages = _ref("stages")
+        packages = _ref("packages")
+
+    all_bookings, has_next = all_bookings_f.result()
+    staff_users = staff_users_f.result()
 
     return render_template(
         "staff_dashboard.html",
@@ -547,7 +751,9 @@ def staff_dashboard():
         stages=stages,
         staff_users=staff_users,
         packages=packages,
-        history_map=history_map
+        history_map=history_map,
+        page=page,
+        has_next=has_next
     )
 
 @app.route("/staff/assign", methods=["POST"])
@@ -556,22 +762,25 @@ def staff_assign():
         return redirect(url_for("login"))
 
     booking_id = int(request.form.get("booking_id"))
-    staff_ids = request.form.getlist("staff_ids")  # multiple
-
-    conn = get_conn()
-    cur = conn.cursor()
-
-    for sid in staff_ids:
-        try:
-            cur.execute("""
-            INSERT INTO booking_staff_assignment(booking_id, staff_id, assigned_at)
-            VALUES(?,?,?)
-            """, (booking_id, int(sid), now_str()))
-        except sqlite3.IntegrityError:
-            pass
+    # validate and dedupe before touching the DB
+    staff_ids = {int(s) for s in request.form.getlist("staff_ids") if s.isdigit()}
 
-    conn.commit()
-    conn.close()
+    ts = now_str()
+    with conn_ctx() as conn:
+        cur = conn.cursor()
+        # whole batch commits (and fsyncs) as one transaction
+        cur.execute("BEGIN IMMEDIATE")
+        # selecting through bookings/users skips ids that don't exist
+        # (stale forms), instead of tripping the FK constraints
+        cur.executemany("""
+        INSERT INTO booking_staff_assignment(booking_id, staff_id, assigned_at)
+        SELECT b.booking_id, u.user_id, ?
+        FROM bookings b, users u
+        WHERE b.booking_id=? AND u.user_id=?
+        ON CONFLICT(booking_id, staff_id) DO NOTHING
+        """, [(ts, booking_id, sid) for sid in staff_ids])
+        conn.commit()
+    _cache_invalidate("staff_dashboard")
     flash("Staff assigned.", "success")
     return redirect(url_for("staff_dashboard"))
 @app.route("/staff/package/create", methods=["POST"])
@@ -585,14 +794,15 @@ def create_package():
     active = 1 if request.form.get("is_active") == "on" else 0
 
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("""
-        INSERT INTO packages(package_name, price, duration_minutes, is_active)
-        VALUES(?,?,?,?)
-        """, (name, price, duration, active))
-        conn.commit()
-        conn.close()
+        with conn_ctx() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+            INSERT INTO packages(package_name, price, duration_minutes, is_active)
+            VALUES(?,?,?,?)
+            """, (name, price, duration, active))
+            conn.commit()
+            _refresh_ref_cache(conn)
+        _cache_invalidate("customer_dashboard", "staff_dashboard")
         flash("Package created.", "success")
     except sqlite3.IntegrityError as e:
         flash(f"Package create failed: {e}", "danger")
@@ -605,12 +815,13 @@ def toggle_package(package_id):
     if not require_staff():
         return redirect(url_for("login"))
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE packages SET is_active = CASE WHEN is_active=1 THEN 0 ELSE 1 END WHERE package_id=?", (package_id,))
-    conn.commit()
-    conn.close()
+    with conn_ctx() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE packages SET is_active = CASE WHEN is_active=1 THEN 0 ELSE 1 END WHERE package_id=?", (package_id,))
+        conn.commit()
+        _refresh_ref_cache(conn)
 
+    _cache_invalidate("customer_dashboard", "staff_dashboard")
     flash("Package status updated.", "success")
     return redirect(url_for("staff_dashboard"))
 @app.route("/staff/user/create", methods=["POST"])
@@ -629,14 +840,14 @@ def create_staff_user():
         return redirect(url_for("staff_dashboard"))
 
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("""
-        INSERT INTO users(full_name, phone, email, password_hash, role, created_at)
-        VALUES(?,?,?,?,?,?)
-        """, (full_name, phone, email, hash_password(password), role, now_str()))
-        conn.commit()
-        conn.close()
+        with conn_ctx() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+            INSERT INTO users(full_name, phone, email, password_hash, role, created_at)
+            VALUES(?,?,?,?,?,?)
+            """, (full_name, phone, email, hash_password(password), role, now_str()))
+            conn.commit()
+        _cache_invalidate("staff_dashboard")
         flash("Staff/Admin user created.", "success")
     except sqlite3.IntegrityError as e:
         flash(f"User create failed: {e}", "danger")
@@ -651,45 +862,47 @@ def staff_update_stage(booking_id):
     new_stage_id = int(request.form.get("stage_id"))
     end_prev = request.form.get("end_prev") == "on"
 
-    conn = get_conn()
-    cur = conn.cursor()
+    ts = now_str()
+    with conn_ctx() as conn:
+        cur = conn.cursor()
 
-    cur.execute("SELECT current_stage_id FROM bookings WHERE booking_id=?", (booking_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        flash("Booking not found.", "danger")
-        return redirect(url_for("staff_dashboard"))
+        cur.execute("SELECT current_stage_id FROM bookings WHERE booking_id=?", (booking_id,))
+        row = cur.fetchone()
+        if not row:
+            flash("Booking not found.", "danger")
+            return redirect(url_for("staff_dashboard"))
 
-    current_stage_id = row[0]
+        current_stage_id = row[0]
 
-    if end_prev and current_stage_id is not None:
-        cur.execute("""
-        UPDATE booking_stage_history
-        SET end_time=?
-        WHERE booking_id=? AND stage_id=? AND end_time IS NULL
-        """, (now_str(), booking_id, current_stage_id))
-
-    # status update
-    cur.execute("SELECT stage_order FROM service_stages WHERE stage_id=?", (new_stage_id,))
-    new_order = cur.fetchone()[0]
-    cur.execute("SELECT MAX(stage_order) FROM service_stages")
-    max_order = cur.fetchone()[0]
-    new_status = "InProgress"
-    if new_order == max_order:
-        new_status = "Completed"
-
-    cur.execute("UPDATE bookings SET current_stage_id=?, status=? WHERE booking_id=?",
-                (new_stage_id, new_status, booking_id))
+        # close-previous, booking update and new history row commit
+        # (and fsync) as one transaction
+        cur.execute("BEGIN IMMEDIATE")
 
-    cur.execute("""
-    INSERT INTO booking_stage_history(booking_id, stage_id, start_time, end_time, updated_by_staff_id)
-    VALUES(?,?,?,?,?)
-    """, (booking_id, new_stage_id, now_str(), None, session["user_id"]))
+        if end_prev and current_stage_id is not None:
+            cur.execute("""
+            UPDATE booking_stage_history
+            SET end_time=?
+            WHERE booking_id=? AND stage_id=? AND end_time IS NULL
+            """, (ts, booking_id, current_stage_id))
 
-    conn.commit()
-    conn.close()
+        # status update
+        new_order = _ref("stage_order")[new_stage_id]
+        max_order = _ref("max_order")
+        new_status = "InProgress"
+        if new_order == max_order:
+            new_status = "Completed"
+
+        cur.execute("UPDATE bookings SET current_stage_id=?, status=? WHERE booking_id=?",
+                    (new_stage_id, new_status, booking_id))
+
+        cur.execute("""
+        INSERT INTO booking_stage_history(booking_id, stage_id, start_time, end_time, updated_by_staff_id)
+        VALUES(?,?,?,?,?)
+        """, (booking_id, new_stage_id, ts, None, session["user_id"]))
 
+        conn.commit()
+
+    _cache_invalidate("customer_dashboard", "staff_dashboard")
     flash("Stage updated and history saved.", "success")
     return redirect(url_for("staff_dashboard"))
 
@@ -702,14 +915,14 @@ def staff_update_payment(booking_id):
     status = request.form.get("payment_status")
     paid_at = now_str() if status == "Paid" else None
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-    UPDATE payments SET method=?, payment_status=?, paid_at=? WHERE booking_id=?
-    """, (method, status, paid_at, booking_id))
-    conn.commit()
-    conn.close()
+    with conn_ctx() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+        UPDATE payments SET method=?, payment_status=?, paid_at=? WHERE booking_id=?
+        """, (method, status, paid_at, booking_id))
+        conn.commit()
 
+    _cache_invalidate("staff_dashboard")
     flash("Payment updated.", "success")
     return redirect(url_for("staff_dashboard"))
 